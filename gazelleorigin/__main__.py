@@ -1,22 +1,20 @@
 #!/usr/bin/env python3
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass
 import argparse
 import io
+import mmap
 import os
-import re
-import subprocess
+import stat
 import sys
+import tempfile
+import time
 from dotenv import dotenv_values
 from typing import Dict
 
-try:
-    import bencoder
-    has_bencoder = True
-except ModuleNotFoundError:
-    has_bencoder = False
-
-import yaml
 from hashlib import sha1
+from urllib.parse import urlparse, parse_qs
 from . import GazelleAPI, GazelleAPIError
 
 
@@ -31,28 +29,157 @@ EXIT_CODES = {
     'input-error': 10
 }
 
+# Default location of the on-disk cache, overridden by the GAZELLE_ORIGIN_CACHE environment variable
+DEFAULT_CACHE_DIR = os.path.join('~', '.cache', 'gazelle-origin')
+# Seconds before cached origin data is refetched, unless --cache-ttl is given
+DEFAULT_CACHE_TTL = 7 * 24 * 60 * 60
+# Seconds before a cached error is retried, however long --cache-ttl is
+ERROR_CACHE_TTL = 60 * 60
+
+_HEX_DIGITS = frozenset('0123456789abcdefABCDEF')
+
+
+def _is_info_hash(s):
+    return len(s) == 40 and _HEX_DIGITS.issuperset(s)
+
+
+def _is_torrent_id(s):
+    return s.isascii() and s.isdigit()
+
+
+def _url_torrent_id(url):
+    """Return the torrent ID from a permalink's torrentid parameter or #torrent<id> fragment, or None."""
+    parsed_url = urlparse(url)
+    torrent_id = parse_qs(parsed_url.query).get('torrentid', ('',))[0]
+    if _is_torrent_id(torrent_id):
+        return torrent_id
+    if parsed_url.fragment.startswith('torrent') and _is_torrent_id(parsed_url.fragment[7:]):
+        return parsed_url.fragment[7:]
+    return None
+
+
+def _skip_bencoded(buf, pos):
+    """Return the offset just past the bencoded value starting at pos."""
+    depth = 0
+    while True:
+        c = buf[pos]
+        if c == 0x64 or c == 0x6c:  # d, l
+            depth += 1
+            pos += 1
+        elif c == 0x65:  # e
+            if not depth:
+                raise ValueError('Unexpected end marker at offset {0}'.format(pos))
+            depth -= 1
+            pos += 1
+        elif c == 0x69:  # i
+            end = buf.find(b'e', pos)
+            if end < 0:
+                raise ValueError('Unterminated integer at offset {0}'.format(pos))
+            pos = end + 1
+        elif 0x30 <= c <= 0x39:  # string length
+            colon = buf.find(b':', pos)
+            if colon < 0:
+                raise ValueError('Unterminated string length at offset {0}'.format(pos))
+            pos = colon + 1 + int(buf[pos:colon])
+        else:
+            raise ValueError('Invalid bencode at offset {0}'.format(pos))
+        if not depth:
+            return pos
+
+
+def _find_info_slice(buf):
+    """
+    Locate the bencoded info dict of a torrent file without decoding it
+    Returns the (start, end) offsets of the value stored under the top level 'info' key
+    """
+    try:
+        if buf[0] != 0x64:
+            raise ValueError('Torrent file is not a bencoded dict')
+        pos = 1
+        while buf[pos] != 0x65:
+            key_end = _skip_bencoded(buf, pos)
+            value_end = _skip_bencoded(buf, key_end)
+            if buf[pos:key_end] == b'4:info':
+                if value_end > len(buf):
+                    raise ValueError('Truncated info dict')
+                return key_end, value_end
+            pos = value_end
+    except IndexError:
+        raise ValueError('Truncated torrent file')
+    raise ValueError('Torrent file has no info dict')
+
+
+def _decode_info_hash(data):
+    """Compute a torrent's info hash by fully decoding it, returns None if it can't be decoded."""
+    # Prefer the C-accelerated better-bencode over the pure Python bencoder
+    try:
+        from better_bencode import loads as bdecode, dumps as bencode
+    except ModuleNotFoundError:
+        try:
+            from bencoder import decode as bdecode, encode as bencode
+        except ModuleNotFoundError:
+            return None
+    try:
+        return sha1(bencode(bdecode(data)[b'info'])).hexdigest()
+    except:
+        return None
+
+
+def _buffer_info_hash(buf):
+    """Compute the info hash of a bencoded torrent in buf, returns None if it isn't a valid torrent."""
+    try:
+        start, end = _find_info_slice(buf)
+    except ValueError:
+        # Fall back to a full decode for anything the scanner couldn't handle
+        return _decode_info_hash(buf[:])
+    with memoryview(buf) as view, view[start:end] as info:
+        return sha1(info).hexdigest()
+
+
+def _torrent_info_hash(path):
+    """Compute the info hash of a .torrent file, returns None if it isn't a valid torrent."""
+    with open(path, 'rb') as f:
+        try:
+            buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (ValueError, OSError):
+            # Empty files can't be mapped, and neither can files on some filesystems
+            return _buffer_info_hash(f.read())
+    with buf:
+        # Hash the info dict straight from the mapped file
+        return _buffer_info_hash(buf)
+
+
 @dataclass
 class TrackerData:
     base_url: str
     api_key_env: str # name of the api key environmental variable
     aliases: list[str]
     api_key: str = None
+    rate_limit: int = 5 # API requests allowed per rate_period seconds
+    rate_period: float = 10
 
 
 TRACKERS = [
     TrackerData(base_url="https://redacted.sh",
             api_key_env="RED_API_KEY",
-            aliases=["red", "flacsfor.me"]),
+            aliases=["red", "flacsfor.me"],
+            rate_limit=10),
     TrackerData(base_url="https://orpheus.network",
             api_key_env="OPS_API_KEY",
             aliases=["ops", "opsfet.ch"])
 ]
 
+ALIAS_TO_TRACKER = {alias: tracker for tracker in TRACKERS for alias in tracker.aliases}
+
 class GazelleOrigin:
     def __init__(self, argv=None):
         self.args = None
         self.api = None
-        self.fetched = {}
+        self.fetched = set()
+        self.executor = None
+        self.pending = deque()
+        self.out_fd = None
+        self.cache_dir = None
 
         parser = argparse.ArgumentParser(
             description='Fetches torrent origin information from Gazelle-based music trackers',
@@ -78,7 +205,10 @@ class GazelleOrigin:
             nargs="?",
             choices=["stop", "ask", "continue"],
             help="Stop, ask, or continue when encountering an error (default: %(default)s)")
-        parser.add_argument('--deduplicate', '-d', action='store_true', help='if specified, only one torrent with any given id/hash will be fetched')
+        parser.add_argument('--deduplicate', '-d', action='store_true', help='if specified, only one torrent with any given id/hash will be fetched, including those already in --out')
+        parser.add_argument('--jobs', '-j', type=int, default=2, metavar='n', help='number of API requests to run at once (default: %(default)s)')
+        parser.add_argument('--no-cache', action='store_true', help='don\'t read or write the on-disk cache of fetched origin data')
+        parser.add_argument('--cache-ttl', type=float, metavar='seconds', default=DEFAULT_CACHE_TTL, help='refetch cached origin data older than this many seconds (default: %(default)s, one week). Cached errors are retried after at most an hour')
 
         for tracker in TRACKERS:
             parser.add_argument('--' + tracker.api_key_env, help=argparse.SUPPRESS, default=os.environ.get(tracker.api_key_env))
@@ -100,6 +230,10 @@ class GazelleOrigin:
                 print('Invalid post script: ' + script)
                 sys.exit(EXIT_CODES['input-error'])
 
+        if args.jobs < 1:
+            print('--jobs must be at least 1', file=sys.stderr)
+            sys.exit(EXIT_CODES['input-error'])
+
         if not args.ORIGIN_TRACKER:
             print(
                 'Tracker must be provided using either --tracker or setting the ORIGIN_TRACKER environment variable.',
@@ -107,11 +241,15 @@ class GazelleOrigin:
             sys.exit(EXIT_CODES['tracker'])
 
         # Search for the tracker with an alias matching the input
-        tracker = next((x for x in TRACKERS if args.ORIGIN_TRACKER.lower() in x.aliases), None)
+        tracker = ALIAS_TO_TRACKER.get(args.ORIGIN_TRACKER.lower())
         if not tracker:
             print('Invalid tracker: {0}'.format(args.ORIGIN_TRACKER), file=sys.stderr)
             sys.exit(EXIT_CODES['tracker'])
 
+        # Torrent IDs are only unique per tracker, so is the cache
+        self.cache_dir = os.path.join(
+            os.environ.get('GAZELLE_ORIGIN_CACHE') or os.path.expanduser(DEFAULT_CACHE_DIR), tracker.aliases[0])
+
         tracker.api_key = args.api_key or getattr(args, tracker.api_key_env)
         if not tracker.api_key:  # Avoid KeyError
             print(
@@ -155,83 +293,174 @@ class GazelleOrigin:
             return 'stop'
 
 
+    def load_fetched(self):
+        """Mark torrents already present in the output file as fetched."""
+        if not self.args.out or not os.path.isfile(self.args.out):
+            return
+        with io.open(self.args.out, encoding='utf-8') as f:
+            for line in f:
+                if line.startswith('Info hash:'):
+                    self.fetched.add(line.split(':', 1)[1].strip().upper())
+                elif line.startswith('Permalink:'):
+                    torrent_id = _url_torrent_id(line.split(':', 1)[1].strip())
+                    if torrent_id:
+                        self.fetched.add(torrent_id)
+
+
     def run(self):
-        for torrent in self.args.torrent:
-            self.handle_input_torrent(torrent)
+        if self.args.deduplicate:
+            self.load_fetched()
+        self.executor = ThreadPoolExecutor(max_workers=self.args.jobs)
+        try:
+            for torrent in self.args.torrent:
+                self.handle_input_torrent(torrent)
+            self.write_pending()
+        finally:
+            self.executor.shutdown(cancel_futures=True)
+            if self.out_fd is not None:
+                os.close(self.out_fd)
 
     def parse_torrent_input(self, torrent, walk=True):
         """
         Parse hash or id of torrent
-        torrent can be an id, hash, url, or path
+        torrent can be an id, hash, url, or path, or an os.DirEntry found while walking a directory
         """
-        # torrent is literal infohash
-        if re.match(r'^[\da-fA-F]{40}$', torrent):
-            return {'hash': torrent}
-        # torrent is literal id
-        if re.match(r'^\d+$', torrent):
-            return {'id': torrent}
+        if isinstance(torrent, os.DirEntry):
+            # Directory entries already know their file type, no need to stat again
+            path = torrent.path
+            exists = True
+            is_dir = torrent.is_dir()
+            is_file = torrent.is_file()
+        else:
+            # torrent is literal infohash
+            if _is_info_hash(torrent):
+                return {'hash': torrent}
+            # torrent is literal id
+            if _is_torrent_id(torrent):
+                return {'id': torrent}
+            path = torrent
+            try:
+                mode = os.stat(path).st_mode
+                exists = True
+            except (OSError, ValueError):
+                mode = 0
+                exists = False
+            is_dir = stat.S_ISDIR(mode)
+            is_file = stat.S_ISREG(mode)
         # torrent is valid path
-        if os.path.exists(torrent):
-            if walk and os.path.isdir(torrent):
-                for path in map(lambda x: os.path.join(torrent, x), os.listdir(torrent)):
-                    self.handle_input_torrent(path, walk=self.args.recursive)
+        if exists:
+            if walk and is_dir:
+                with os.scandir(path) as entries:
+                    for entry in entries:
+                        self.handle_input_torrent(entry, walk=self.args.recursive)
                 return 'walked'
             # If file/dir name is info hash use that
-            filename = os.path.split(torrent)[-1].split('.')[0]
-            if re.match(r'^[\da-fA-F]{40}$', filename):
-                return {'hash': filename}
+            stem = os.path.basename(path).partition('.')[0]
+            if _is_info_hash(stem):
+                return {'hash': stem}
             # If torrent file compute the info hash
-            if not self.args.no_hash and os.path.isfile(torrent) and os.path.split(torrent)[-1].endswith('.torrent'):
-                if has_bencoder:
-                    with open(torrent, 'rb') as torrent:
-                        try:
-                            decoded = bencoder.decode(torrent.read())
-                            info_hash = sha1(bencoder.encode(decoded[b'info'])).hexdigest()
-                        except:
-                            return None
-                        return {'hash': info_hash}
-                else:
-                    print('Found torrent file ' + torrent + ' but unable to load bencoder module to compute hash')
-                    print('Install bencoder (pip install bencoder) then try again or pass --no-hash to not compute the hash')
-                    if self.handle_invalid() != "stop":
-                        return None
-                    else:
-                        sys.exit(EXIT_CODES['input-error'])
+            if not self.args.no_hash and is_file and path.endswith('.torrent'):
+                info_hash = _torrent_info_hash(path)
+                return {'hash': info_hash} if info_hash else None
         # torrent is a URL
-        url_match = re.match(r'.*torrentid=(\d+).*', torrent)
-        if not url_match or url_match.lastindex < 1:
+        torrent_id = _url_torrent_id(path)
+        if not torrent_id:
             return None
-        return {'id': url_match[1]}
+        return {'id': torrent_id}
 
     def handle_input_torrent(self, torrent, walk=True):
         """
         Get torrent's info from GazelleAPI
-        torrent can be an id, hash, url, or path
+        torrent can be an id, hash, url, or path, or an os.DirEntry found while walking a directory
         """
-        print("Handling {}".format(torrent))
+        name = os.fspath(torrent)
+        print("Handling {}".format(name))
         parsed = self.parse_torrent_input(torrent, walk)
         if parsed == 'walked':
             return
         if not parsed:
-            print('Invalid torrent ID, hash, file, or URL: ' + torrent, file=sys.stderr)
+            print('Invalid torrent ID, hash, file, or URL: ' + name, file=sys.stderr)
             if self.handle_invalid() != "stop":
                 return
             else:
                 sys.exit(EXIT_CODES["hash"])
 
         if self.args.deduplicate:
-            if 'id' in parsed:
-                if parsed['id'] in self.fetched:
-                    return
-                self.fetched[parsed['id']] = True
-            if 'hash' in parsed:
-                if parsed['hash'] in self.fetched:
-                    return
-                self.fetched[parsed['hash']] = True
-
-        # Actually get the info from the API
+            key = parsed.get('id') or parsed['hash'].upper()
+            if key in self.fetched:
+                return
+            self.fetched.add(key)
+
+        # Keep at most --jobs lookups in flight so errors are handled close to the input that caused them
+        self.write_pending(self.args.jobs - 1)
+        # Actually get the info from the API in the background
+        self.pending.append((name, self.executor.submit(self.fetch_torrent_info, parsed)))
+
+    def write_pending(self, max_pending=0):
+        """
+        Write out finished lookups in input order
+        Waits for the oldest lookup while more than max_pending are outstanding
+        """
+        while self.pending and (len(self.pending) > max_pending or self.pending[0][1].done()):
+            torrent, future = self.pending.popleft()
+            self.write_torrent_info(torrent, future)
+
+    def fetch_torrent_info(self, parsed):
+        """
+        Get torrent's info from the on-disk cache, or from GazelleAPI if it isn't cached
+        Torrents that are missing or not music are cached too, and raise the same error again for up to an hour
+        """
+        if self.args.no_cache:
+            return self.api.get_torrent_info(**parsed)
+
+        cache_path = os.path.join(self.cache_dir, parsed['hash'].upper() if 'hash' in parsed else parsed['id'])
+        info = self.read_cache(cache_path + '.yaml', self.args.cache_ttl)
+        if info is not None:
+            return info
+        error = self.read_cache(cache_path + '.error', min(self.args.cache_ttl, ERROR_CACHE_TTL))
+        if error is not None:
+            code, _, message = error.partition('\n')
+            raise GazelleAPIError(code, message)
+
         try:
             info = self.api.get_torrent_info(**parsed)
+        except GazelleAPIError as e:
+            if e.code == 'music' or e.code == 'request-json':
+                self.write_cache(cache_path + '.error', '{0}\n{1}'.format(e.code, e.message))
+            raise
+        self.write_cache(cache_path + '.yaml', info)
+        return info
+
+    def read_cache(self, path, ttl):
+        """Return the contents of a cache file, or None if it doesn't exist or is older than ttl seconds."""
+        try:
+            if time.time() - os.stat(path).st_mtime > ttl:
+                return None
+            with io.open(path, encoding='utf-8', newline='') as f:
+                return f.read()
+        except OSError:
+            return None
+
+    def write_cache(self, path, data):
+        """Atomically replace a cache file. The cache is only an optimization, so failures are ignored."""
+        tmp_path = None
+        try:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, suffix='.tmp')
+            with io.open(fd, 'w', encoding='utf-8', newline='') as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        except OSError:
+            if tmp_path and os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    def write_torrent_info(self, torrent, future):
+        """
+        Wait for a torrent's info from GazelleAPI and write it out
+        torrent is the input the info was requested for
+        """
+        try:
+            info = future.result()
         except GazelleAPIError as e:
             if self.handle_invalid() == "stop":
                 skip = False
@@ -248,13 +477,20 @@ class GazelleOrigin:
                 sys.exit(EXIT_CODES[e.code])
 
         if self.args.out:
-            with io.open(self.args.out, 'a' if os.path.exists(self.args.out) else 'w', encoding='utf-8') as f:
-                f.write(info)
+            # Opened on the first write so nothing is created if every torrent fails
+            if self.out_fd is None:
+                self.out_fd = os.open(self.args.out, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+            data = memoryview(info.encode('utf-8'))
+            while data:
+                data = data[os.write(self.out_fd, data):]
         else:
             print(info, end='')
 
         if self.args.post:
-            fetched_info = yaml.load(info, Loader=yaml.SafeLoader)
+            import subprocess
+            import yaml
+
+            fetched_info = yaml.load(info, Loader=getattr(yaml, 'CSafeLoader', yaml.SafeLoader))
             for script in self.args.post:
                 subprocess.run(script, shell=True, env={k.upper(): str(v) for k, v in {**vars(self.args), **fetched_info}.items()})
 
@@ -1,11 +1,21 @@
 from __future__ import annotations
+from collections import deque
+from functools import lru_cache, partial
 from typing import TYPE_CHECKING
+import os
 import re
 import html
-import json
-import requests
 import textwrap
-import yaml
+import threading
+import time
+from urllib.parse import urlencode
+
+try:
+    from orjson import loads as json_loads
+except ModuleNotFoundError:
+    from json import loads as json_loads
+
+# urllib3 and yaml are imported where they are used to keep startup fast
 
 if TYPE_CHECKING:
     from gazelleorigin.__main__ import TrackerData
@@ -20,6 +30,128 @@ headers = {
     'Accept-Charset': 'ISO-8859-1,utf-8;q=0.7,*;q=0.3'}
 
 
+# Single line strings yaml can emit without escapes
+_PRINTABLE_RE = re.compile('[\x20-\x7E\xA0-\u2027\u202A-\uD7FF\uE000-\uFEFE\uFF00-\uFFFD\U00010000-\U0010FFFE]*\\Z')
+# Printable strings yaml emits as plain (unquoted) block scalars, if they don't resolve to another type.
+# Mirrors the block plain checks in yaml.emitter.Emitter.analyze_scalar
+_PLAIN_RE = re.compile(r'''
+    (?!---|\.\.\.)                      # not a document marker
+    (?![-?:](?:\ |\Z))                  # no leading '- ', '? ' or ': ' indicator
+    [^\ \#,\[\]{}&*!|>'"%@`]            # no leading space or indicator character
+    (?:[^:\#] | :(?!\ ) | (?<!\ )\#)*   # no ': ' or ' #' inside
+    (?<![\ :])\Z                        # no trailing space or ':'
+''', re.VERBOSE)
+_STR_TAG = 'tag:yaml.org,2002:str'
+# Characters libyaml escapes even with allow_unicode, unlike the pure Python emitter
+_LIBYAML_ESCAPED_RE = re.compile('[\x85\U00010000-\U0010FFFF]')
+# Never wrap lines, libyaml needs the width as a C int rather than float('inf')
+_YAML_WIDTH = 2**31 - 1
+_FILE_LIST_RE = re.compile(r"(?P<Name>.*?){{{(?P<Size>\d+)}}}(\|\|\|)?")
+# Release type names indexed by their number
+_RELEASE_CODES = tuple({
+    1: "Album",
+    3: "Soundtrack",
+    5: "EP",
+    6: "Anthology",
+    7: "Compilation",
+    9: "Single",
+    11: "Live album",
+    13: "Remix",
+    14: "Bootleg",
+    15: "Interview",
+    16: "Mixtape",
+    17: "Demo",
+    18: "Concert Recording",
+    19: "DJ Mix",
+    21: "Unknown"
+}.get(i, "none") for i in range(22))
+# musicInfo artist categories included in the output
+_ARTIST_CATEGORIES = ('artists', 'with', 'producer', 'remixedBy', 'dj', 'composers', 'conductor')
+
+
+def _safe_dumper(text):
+    """
+    Return libyaml's CSafeDumper if available and it emits text the same as the pure Python SafeDumper,
+    otherwise SafeDumper
+    """
+    import yaml
+    if _LIBYAML_ESCAPED_RE.search(text):
+        return yaml.SafeDumper
+    return getattr(yaml, 'CSafeDumper', yaml.SafeDumper)
+
+
+@lru_cache(maxsize=None)
+def _yaml_implicit_tag():
+    """Return a function giving the tag yaml resolves an unquoted scalar to."""
+    import yaml
+    return partial(yaml.resolver.Resolver().resolve, yaml.ScalarNode, implicit=(True, False))
+
+
+def _yaml_scalar(value, implicit_tag):
+    """
+    Format a value the same way yaml.dump emits it in a block mapping
+    implicit_tag is the function returned by _yaml_implicit_tag()
+    """
+    if value is None:
+        return 'null'
+    if isinstance(value, bool):
+        return 'true' if value else 'false'
+    if not isinstance(value, str):
+        return str(value)
+    if not _PRINTABLE_RE.match(value):
+        # Escaping is rare enough to leave to yaml itself
+        import yaml
+        return yaml.dump(value, Dumper=yaml.SafeDumper, width=_YAML_WIDTH, allow_unicode=True).rstrip('\n')
+    if _PLAIN_RE.match(value) and implicit_tag(value) == _STR_TAG:
+        return value
+    return "'" + value.replace("'", "''") + "'"
+
+
+def _unescape(value):
+    """html.unescape strings that contain entities, return anything else untouched."""
+    return html.unescape(value) if isinstance(value, str) and '&' in value else value
+
+
+def _parse_file_list(file_list):
+    """Split a fileList of the form 'name{{{size}}}|||name{{{size}}}' into Name/Size dicts."""
+    if '\n' not in file_list:
+        entries = file_list.split('|||')
+        # Only the final entry may be empty, from a trailing separator
+        if not entries[-1]:
+            entries.pop()
+        files = []
+        for entry in entries:
+            name, sep, size = entry.rpartition('{{{')
+            # A '}}}' in the name may close an earlier size, leave that to the regex
+            if not sep or size[-3:] != '}}}' or not size[:-3].isdigit() or '}}}' in name:
+                break
+            files.append({'Name': name, 'Size': size[:-3]})
+        else:
+            return files
+    # Let the regex sort out anything unusual
+    return [m.groupdict() for m in _FILE_LIST_RE.finditer(file_list)]
+
+
+class RateLimiter:
+    """Blocks callers of wait() so that no more than `calls` calls go through in any `period` seconds."""
+    def __init__(self, calls, period):
+        self.calls = calls
+        self.period = period
+        self.lock = threading.Lock()
+        self.history = deque()
+
+    def wait(self):
+        with self.lock:
+            while True:
+                now = time.monotonic()
+                while self.history and now - self.history[0] >= self.period:
+                    self.history.popleft()
+                if len(self.history) < self.calls:
+                    self.history.append(now)
+                    return
+                time.sleep(self.period - (now - self.history[0]))
+
+
 class GazelleAPIError(Exception):
     def __init__(self, code, message):
         super().__init__()
@@ -30,13 +162,50 @@ class GazelleAPIError(Exception):
         return self.message
 
 
+def _pool_manager(url, **kwargs):
+    """
+    Build a urllib3 pool for url that honours the same proxy (HTTP(S)_PROXY, ALL_PROXY, NO_PROXY) and CA bundle
+    (REQUESTS_CA_BUNDLE, CURL_CA_BUNDLE) environment variables that requests does
+    """
+    import urllib3
+    from urllib.parse import unquote, urlsplit
+    from urllib.request import getproxies, proxy_bypass
+
+    ca_bundle = os.environ.get('REQUESTS_CA_BUNDLE') or os.environ.get('CURL_CA_BUNDLE')
+    if ca_bundle:
+        kwargs['ca_cert_dir' if os.path.isdir(ca_bundle) else 'ca_certs'] = ca_bundle
+
+    parts = urlsplit(url)
+    proxies = getproxies()
+    proxy = proxies.get(parts.scheme) or proxies.get('all')
+    if not proxy or proxy_bypass(parts.hostname):
+        return urllib3.PoolManager(**kwargs)
+    if '://' not in proxy:
+        proxy = 'http://' + proxy
+    if proxy.startswith('socks'):
+        from urllib3.contrib.socks import SOCKSProxyManager
+        return SOCKSProxyManager(proxy, **kwargs)
+    auth = urllib3.util.parse_url(proxy).auth
+    proxy_headers = None
+    if auth:
+        # Credentials in the URL are percent-encoded, but the header needs them as typed
+        username, _, password = auth.partition(':')
+        proxy_headers = urllib3.make_headers(proxy_basic_auth=unquote(username) + ':' + unquote(password))
+    return urllib3.ProxyManager(proxy, proxy_headers=proxy_headers, **kwargs)
+
+
 # GazelleAPI code is based off of REDbetter (https://github.com/Mechazawa/REDBetter-crawler).
 class GazelleAPI:
     def __init__(self, tracker: TrackerData = None):
+        import urllib3
+
         self.base = tracker.base_url
-        self.session = requests.Session()
-        self.session.headers.update(headers)
-        self.session.headers.update({'Authorization': tracker.api_key})
+        # Keep enough connections alive for concurrent lookups and retry transient server errors
+        retry = urllib3.Retry(total=3, backoff_factor=0.5, status_forcelist=[429, 502, 503, 504], raise_on_status=False)
+        self.http = _pool_manager(self.base, maxsize=16, retries=retry,
+                                  headers={**headers, 'Authorization': tracker.api_key})
+        # Shared by all threads so concurrent lookups stay within the tracker's API rate limit
+        self.rate_limiter = RateLimiter(tracker.rate_limit, tracker.rate_period)
 
     def request(self, action, **kwargs):
         params = {'action': action}
@@ -44,29 +213,33 @@ class GazelleAPI:
         return self._get_parsed_response(params)
 
     def _get_parsed_response(self, params):
-        r = self.session.get(self.base + "/ajax.php", params=params, allow_redirects=False, timeout=30)
-        if r.status_code == 401 or r.status_code == 403:
-            raise GazelleAPIError('unauthorized', 'Authentication error: ' + r.json()['error'])
-        if r.status_code != 200:
+        query = urlencode({k: v for k, v in params.items() if v is not None})
+        self.rate_limiter.wait()
+        r = self.http.request('GET', '{0}/ajax.php?{1}'.format(self.base, query), redirect=False, timeout=30)
+        if r.status == 401 or r.status == 403:
+            raise GazelleAPIError('unauthorized', 'Authentication error: ' + json_loads(r.data)['error'])
+        if r.status != 200:
             raise GazelleAPIError('request',
-                'Could not retrieve origin data. Try again later. (status {0})'.format(r.status_code))
+                'Could not retrieve origin data. Try again later. (status {0})'.format(r.status))
 
-        parsed = json.loads(r.content)
+        parsed = json_loads(r.data)
         if parsed['status'] != 'success':
             raise GazelleAPIError('request-json', 'Could not retrieve origin data. Check the torrent ID/hash or try again later.')
 
         return parsed['response']
 
     def _make_table(self, dict):
-        k_width = max(len(html.unescape(k)) for k in dict.keys()) + 2
+        k_width = max(len(_unescape(k)) for k in dict.keys()) + 2
         result = ''
         for k,v in dict.items():
             if v == "''":
                 v = '~'
-            result += "".join((html.unescape((k + ':').ljust(k_width)), v)) + '\n'
+            result += "".join((_unescape((k + ':').ljust(k_width)), v)) + '\n'
         return result
 
     def get_torrent_info(self, hash=None, id=None):
+        import yaml
+
         info = self.request('torrent', hash=hash, id=id)
         group = info['group']
         torrent = info['torrent']
@@ -82,36 +255,15 @@ class GazelleAPI:
         else:
             artists = 'Various Artists'
 
-        delimited_artists = {category: ', '.join([artist['name'] for artist in artist_list])
-         for category, artist_list in musicInfo.items()}
-
-        # Maps release type numbers to their string values
-        release_codes = {
-            1: "Album",
-            3: "Soundtrack",
-            5: "EP",
-            6: "Anthology",
-            7: "Compilation",
-            9: "Single",
-            11: "Live album",
-            13: "Remix",
-            14: "Bootleg",
-            15: "Interview",
-            16: "Mixtape",
-            17: "Demo",
-            18: "Concert Recording",
-            19: "DJ Mix",
-            21: "Unknown"
-        }
-        releaseTypes = release_codes.get(group['releaseType'], "none")
-
-        file_list = [m.groupdict() for m in
-                     re.finditer(r"(?P<Name>.*?){{{(?P<Size>\d+)}}}(\|\|\|)?", torrent['fileList'])]
-
-        # If the api can return empty tags
-        group['tags'] = group.get('tags', '')
-
-        info_dict = {k:html.unescape(v) if isinstance(v, str) else v for k,v in {
+        delimited_artists = {category: ', '.join(artist['name'] for artist in musicInfo.get(category, ()))
+         for category in _ARTIST_CATEGORIES}
+
+        releaseType = group['releaseType']
+        releaseTypes = _RELEASE_CODES[releaseType] if isinstance(releaseType, int) and 0 <= releaseType < len(_RELEASE_CODES) else "none"
+
+        file_list = _parse_file_list(torrent['fileList'])
+
+        info_dict = {k:_unescape(v) for k,v in {
             'Artist':                  artists,
             'Name':                    group['name'],
             'Release type':            releaseTypes,
@@ -119,7 +271,7 @@ class GazelleAPI:
             'Catalog number':          torrent['remasterCatalogueNumber'],
             'Edition year':            torrent['remasterYear'] or '',
             'Edition':                 torrent['remasterTitle'],
-            'Tags':                    str(', '.join(str(tag) for tag in group['tags'])),
+            'Tags':                    ', '.join(group.get('tags') or ()),  # the api can return empty tags
             'Main artists':            delimited_artists['artists'],
             'Featured artists':        delimited_artists['with'],
             'Producers':               delimited_artists['producer'],
@@ -143,25 +295,21 @@ class GazelleAPI:
             'Permalink':               f'{self.base}/torrents.php?torrentid={torrent["id"]}',
         }.items()}
 
-        dump = yaml.dump(info_dict, width=float('inf'), sort_keys=False, allow_unicode=True)
-
-        out = {}
-        for line in dump.strip().split('\n'):
-            key, value = line.split(':', 1)
-            if key == 'Uploaded' or key == 'Encoding':
-                value = value.replace("'", '')
-            out[key] = value.strip()
+        # Uploaded and Encoding are written unquoted even if they look like another type
+        implicit_tag = _yaml_implicit_tag()
+        out = {k: str(v) if k == 'Uploaded' or k == 'Encoding' else _yaml_scalar(v, implicit_tag)
+               for k, v in info_dict.items()}
 
         result = self._make_table(out) + '\n'
 
-        comment = html.unescape(torrent['description']).strip('\r\n')
+        comment = _unescape(torrent['description']).strip('\r\n')
         if comment:
             comment = textwrap.indent(comment, '  ', lambda line: True)
             result += 'Comment: |-\n{0}\n\n'.format(comment)
 
-        result += yaml.dump({'Files': file_list}, width=float('inf'), allow_unicode=True)
+        result += yaml.dump({'Files': file_list}, Dumper=_safe_dumper(torrent['fileList']), width=_YAML_WIDTH, allow_unicode=True)
 
-        groupDescription = html.unescape(group.get('bbBody') or group.get('wikiBBcode')).strip('\r\n')
+        groupDescription = _unescape(group.get('bbBody') or group.get('wikiBBcode')).strip('\r\n')
         if groupDescription:
             groupDescription = textwrap.indent(groupDescription, '  ', lambda line: True)
             result += '\n\nDescription: |-\n{0}\n\n'.format(groupDescription)
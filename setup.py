@@ -23,7 +23,7 @@ setuptools.setup(
     python_requires='>=3.5.2',
     install_requires=[
         "pyyaml",
-        "requests",
+        "urllib3",
         "python-dotenv",
     ],
 )